@@ -5,112 +5,416 @@ Description:
     (Using this algorithm for tuning hyper-parameters of deep unfolding network)
 """
 
-import random
+import os
+import logging
+import logging.config
+import contextlib
+import multiprocessing
+import shutil
+import tempfile
+import warnings
 import math
-from keras.models import Sequential
-from keras.layers import Conv2D, MaxPooling2D, Dense, Flatten, Dropout
+import numpy as np
+import tensorflow as tf
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from numba import njit, prange
+from scipy.optimize import curve_fit, OptimizeWarning
+from keras import mixed_precision
+from keras import backend as K
+from keras.models import Model
+from keras.layers import Input, Conv2D, MaxPooling2D, Dense, Flatten, Dropout
+from keras.callbacks import Callback
+from keras.optimizers import Adam
+
+@contextlib.contextmanager
+def quiet_pyswarms():
+    """Keep pyswarms' Reporter (created on import and by each optimizer) from replacing the root logging
+    config with its own handlers and from opening ./report.log."""
+    dict_config, logging.config.dictConfig = logging.config.dictConfig, lambda config: None
+    try:
+        yield
+    finally:
+        logging.config.dictConfig = dict_config
+
+with quiet_pyswarms():
+    from pyswarms.backend import Swarm, compute_pbest
+    from pyswarms.backend.handlers import BoundaryHandler, VelocityHandler
+    from pyswarms.backend.topology import Star
+
+logger = logging.getLogger(__name__)                    # Level left to the application's logging config
+
+MODEL_CACHE_SIZE = 16                                   # Compiled models kept per process
+DATASET_CACHE_SIZE = 2                                  # (x, y) pairs whose tf.data pipelines are kept per process
+LVL2_PENALTY = 1.0                                      # pyswarms cost of CNNs that can't be built (others cost -accuracy)
+VALIDATION_SPLIT = 0.2                                  # Fraction of the training data the fitness is measured on
+QUANTIZED_FITNESS_MIN_SAMPLES = None                    # On CPU, score larger validation splits with an int8 TFLite
+                                                        # model (None: off until timed against model.evaluate)
+_model_cache = OrderedDict()                            # Architecture hash -> (compiled model, initial weights)
+_use_mixed_precision = None                             # Set once per process by setup_gpus()
+_datasets = OrderedDict()                               # (id(x), id(y)) -> (x, y, train_ds, val_ds)
+_shared_arrays = {}                                     # Shared memory name -> (SharedMemory, ndarray view)
+
+def setup_gpus():
+    """Enable GPU memory growth and, if a GPU is present, the mixed_float16 policy (once per process)."""
+    global _use_mixed_precision
+    if _use_mixed_precision is None:
+        gpus = tf.config.list_physical_devices('GPU')
+        for gpu in gpus:
+            tf.config.experimental.set_memory_growth(gpu, True)
+        if gpus:
+            mixed_precision.set_global_policy('mixed_float16')
+        _use_mixed_precision = bool(gpus)
+    return _use_mixed_precision
+
+def get_datasets(x, y, batch_size=128, validation_split=VALIDATION_SPLIT):
+    """Return cached tf.data pipelines (train, validation) over (x, y), built once per process.
+
+    Only the DATASET_CACHE_SIZE most recently used pairs are kept, so re-running an optimizer on new
+    arrays doesn't pile up in-memory copies of the old ones.
+    """
+    key = (id(x), id(y))
+    if key in _datasets and _datasets[key][0] is x and _datasets[key][1] is y:
+        _datasets.move_to_end(key)
+    else:
+        n = len(x) - int(len(x) * validation_split)
+        train = tf.data.Dataset.from_tensor_slices((x[:n], y[:n]))
+        val = tf.data.Dataset.from_tensor_slices((x[n:], y[n:]))
+        _datasets[key] = (x, y,
+                          train.cache().shuffle(10000).batch(batch_size).prefetch(tf.data.AUTOTUNE),
+                          val.batch(batch_size).cache().prefetch(tf.data.AUTOTUNE))
+        _datasets.move_to_end(key)
+        if len(_datasets) > DATASET_CACHE_SIZE:
+            _datasets.popitem(last=False)
+    return _datasets[key][2:]
+
+def share_array(a):
+    """Copy an array into POSIX shared memory once and return the (name, shape, dtype) handle workers attach to."""
+    shm = SharedMemory(create=True, size=max(a.nbytes, 1))
+    view = np.ndarray(a.shape, a.dtype, buffer=shm.buf)
+    view[...] = a
+    _shared_arrays[shm.name] = (shm, view)
+    return shm.name, a.shape, a.dtype.str
+
+def attach_array(handle):
+    """Return this process' view of a shared array (the same ndarray on every call, so get_datasets caches it)."""
+    name, shape, dtype = handle
+    if name not in _shared_arrays:
+        shm = SharedMemory(name=name)
+        _shared_arrays[name] = (shm, np.ndarray(shape, dtype, buffer=shm.buf))
+    return _shared_arrays[name][1]
+
+def unlink_array(handle):
+    """Free a shared array once the processes using it are done (views workers attached stay valid)."""
+    shm, view = _shared_arrays.pop(handle[0])
+    del view
+    shm.close()
+    shm.unlink()
+
+def log_to_file(path):
+    """Append this process' optimizer log to a file (keeps worker processes off the shared stdout), once per path."""
+    if any(getattr(h, 'baseFilename', None) == os.path.abspath(path) for h in logger.handlers):
+        return
+    handler = logging.FileHandler(path)
+    handler.setFormatter(logging.Formatter('%(asctime)s [%(process)d] %(message)s'))
+    logger.addHandler(handler)
+
+def make_client(n_workers, n_gpus=0):
+    """Start a local Dask cluster of single-threaded workers (so TF sessions don't collide), pinned round-robin to n_gpus GPUs."""
+    from dask.distributed import Client                 # Optional dependency, only needed with a client
+    client = Client(n_workers=n_workers, threads_per_worker=1)
+    if n_gpus:
+        client.run(_pin_gpu, n_gpus)
+    return client
+
+def _pin_gpu(n_gpus, dask_worker):
+    os.environ['CUDA_VISIBLE_DEVICES'] = str(dask_worker.name % n_gpus)
+
+def _init_process(ranks, n_gpus, log_file):
+    if log_file is not None:
+        log_to_file(log_file)
+    if n_gpus:
+        os.environ['CUDA_VISIBLE_DEVICES'] = str(ranks.get() % n_gpus)
+
+def _run_level2(hybrid, particle_l1, w, seed):
+    """Optimize one Level-1 particle's Level-2 swarm in a worker process; return what the parent has to merge back."""
+    np.random.seed(seed)                                # pyswarms draws from the legacy global generator
+    known = set(hybrid.fitness_cache)
+    gbest_ij, F_i = hybrid.level2_optimize(particle_l1, w)
+    new_fitnesses = {key: F for key, F in hybrid.fitness_cache.items() if key not in known}
+    return gbest_ij, F_i, particle_l1.swarm_lvl2_state, new_fitnesses
+
+def eval_particle(l1_pos, l2_pos, x, y, input_shape, output_shape, gbest_F=-float("inf"),
+                  epochs=10, initial_epoch=0, checkpoint=None):
+    """Build and train the CNN encoded by a Level-1/Level-2 particle pair and return its fitness.
+
+    The fitness is the accuracy on the validation split of (x, y), the metric PredictiveEarlyStop extrapolates.
+
+    With a checkpoint path, training resumes from the weights (and validation accuracy curve) saved
+    there when initial_epoch > 0 and both are saved back, so a successive-halving rung only pays for
+    its extra epochs and PredictiveEarlyStop extrapolates the curve of all rungs so far.
+    x and y may also be share_array handles, which Dask tasks receive instead of the arrays.
+    """
+    if isinstance(x, tuple):
+        x, y = attach_array(x), attach_array(y)
+    train_ds, val_ds = get_datasets(x, y)
+    cnn = CNN(l1_pos, l2_pos)
+    cnn.buid_model(input_shape, output_shape)
+    val_acc = []
+    if checkpoint is not None and initial_epoch > 0:
+        cnn.model.load_weights(checkpoint)
+        val_acc = np.load(f"{checkpoint}.val_acc.npy").tolist()
+    history = cnn.train_model(train_ds, val_ds, epochs, gbest_F, initial_epoch, val_acc)
+    if checkpoint is not None:
+        cnn.model.save_weights(checkpoint)
+        np.save(f"{checkpoint}.val_acc.npy", val_acc + history.history['val_accuracy'])
+    quantized = (QUANTIZED_FITNESS_MIN_SAMPLES is not None and not setup_gpus()
+                 and int(len(x) * VALIDATION_SPLIT) > QUANTIZED_FITNESS_MIN_SAMPLES)
+    return cnn.fitness(val_ds, quantized=quantized)[1]
+
+def eval_particles(keys, x, y, input_shape, output_shape, epochs=10, initial_epoch=0, checkpoints=None):
+    """Train the CNNs of several (l1_pos, l2_pos) pairs jointly, as heads of one model on a shared input.
+
+    Returns one fitness per key (-inf for architectures that can't be built). Each head is also
+    wrapped in its own Model so checkpoints (and validation curves) are interchangeable with those
+    of eval_particle.
+    """
+    setup_gpus()
+    train_ds, val_ds = get_datasets(x, y)
+    inputs = Input(shape = input_shape)
+    heads = {}
+    for n, key in enumerate(keys):
+        cnn = CNN(*key)
+        try:
+            cnn.model = Model(inputs, cnn.build_head(inputs, output_shape, name=f"head_{n}"))
+        except Exception as e:
+            logger.info("^^^^^^ Invalid hyperparameters %s ^^^^^^ %s", key, e)
+            continue
+        cnn.val_acc = []
+        if checkpoints is not None and initial_epoch > 0:
+            cnn.model.load_weights(checkpoints[n])
+            cnn.val_acc = np.load(f"{checkpoints[n]}.val_acc.npy").tolist()
+        heads[n] = cnn
+    fitnesses = [-float("inf")] * len(keys)
+    if not heads:
+        return fitnesses
+
+    model = Model(inputs, [cnn.model.output for cnn in heads.values()])
+    compile_model(model, {f"head_{n}": ['accuracy'] for n in heads})
+    repeat = lambda x, y: (x, (y,) * len(heads))
+    history = model.fit(train_ds.map(repeat), validation_data=val_ds.map(repeat), epochs=initial_epoch + epochs,
+                        initial_epoch=initial_epoch)
+    results = model.evaluate(val_ds.map(repeat), return_dict=True)
+    for n, cnn in heads.items():
+        if checkpoints is not None:
+            cnn.model.save_weights(checkpoints[n])
+            np.save(f"{checkpoints[n]}.val_acc.npy", cnn.val_acc + head_metric(history.history, n, 'val_'))
+        fitnesses[n] = head_metric(results, n)
+    return fitnesses
+
+def head_metric(logs, n, prefix=''):
+    """Accuracy of head n in Keras logs (metric names only carry the output name with several outputs)."""
+    name = f"{prefix}head_{n}_accuracy"
+    return logs[name] if name in logs else logs[f"{prefix}accuracy"]
+
+class PredictiveEarlyStop(Callback):
+    """Stop training once the validation accuracy curve, extrapolated as a - b*exp(-c*t), can't reach gbest_F.
+
+    gbest_F must be a validation accuracy too (see eval_particle). val_acc holds the curve of the epochs
+    trained before this fit() call (earlier successive-halving rungs), so the fit spans all of them.
+    """
+    def __init__(self, gbest_F, val_acc=(), margin=0.01, min_epochs=3):
+        super().__init__()
+        self.gbest_F = gbest_F                          # Current global best fitness
+        self.margin = margin                            # Tolerance on the predicted asymptote
+        self.min_epochs = min_epochs                    # Epochs observed before extrapolating
+        self.initial_val_acc = list(val_acc)            # Validation accuracies of earlier rungs
+        self.val_acc = list(val_acc)
+
+    def on_train_begin(self, logs=None):
+        self.val_acc = list(self.initial_val_acc)
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.val_acc.append(logs['val_accuracy'])
+        if len(self.val_acc) < self.min_epochs:
+            return
+        t = np.arange(1, len(self.val_acc) + 1)
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', OptimizeWarning)
+                (a, b, c), _ = curve_fit(lambda t, a, b, c: a - b * np.exp(-c * t), t, self.val_acc,
+                                         p0=(self.val_acc[-1], self.val_acc[-1] - self.val_acc[0], 0.5),
+                                         bounds=([-np.inf, -np.inf, 0], np.inf))
+        except (RuntimeError, ValueError):
+            return
+        if a < self.gbest_F - self.margin:
+            logger.info("^^^^^^ Predicted accuracy %.4f < gbest %.4f, stopping at epoch %d ^^^^^^", a, self.gbest_F, epoch+1)
+            self.model.stop_training = True
+
+def reset_optimizer(optimizer):
+    """Zero the step counter and moment slots of a compiled model's optimizer (not its learning rate or betas),
+    so a cached model trains from scratch with the train function it already traced."""
+    optimizer = getattr(optimizer, 'inner_optimizer', optimizer)   # Keep the loss scale of a LossScaleOptimizer
+    variables = optimizer.variables() if callable(optimizer.variables) else optimizer.variables
+    for v in variables:
+        if not any(hyper in v.name for hyper in ('learning_rate', 'beta_1', 'beta_2', 'decay', 'epsilon')):
+            v.assign(tf.zeros_like(v))
+
+def compile_model(model, metrics=None):
+    """Compile a model with a fresh Adam optimizer (loss-scaled under mixed precision), so it trains from scratch."""
+    optimizer = mixed_precision.LossScaleOptimizer(Adam()) if setup_gpus() else Adam()
+    model.compile(optimizer=optimizer, loss='mse', metrics=metrics or ['accuracy'])
+
+def init_swarm(N, D):
+    """Allocate the state of a swarm of N particles in D dimensions as arrays (one row per particle)."""
+    return {
+            'pos':     np.empty((N, D), np.float32),    # Particle positions
+            'vel':     np.zeros((N, D), np.float32),    # Particle velocities
+            'pbest':   np.empty((N, D), np.float32),    # Personal best positions
+            'gbest':   np.zeros(D, np.float32),         # Global best position
+            'lo':      np.empty((N, D), np.float32),    # Lower bounds of positions
+            'hi':      np.empty((N, D), np.float32),    # Upper bounds of positions
+            'vmax':    np.empty((N, D), np.float32),    # Maximum velocities (see set_max_vel)
+            'F':       np.full(N, -np.inf),             # Current fitnesses
+            'pbest_F': np.full(N, -np.inf),             # Personal best fitnesses
+           }
+
+def update_pbest(swarm):
+    """Update personal bests from current fitnesses and the global best from personal bests."""
+    improved = swarm['F'] > swarm['pbest_F']
+    swarm['pbest'][improved] = swarm['pos'][improved]
+    swarm['pbest_F'][improved] = swarm['F'][improved]
+    best = np.argmax(swarm['pbest_F'])
+    swarm['gbest'][:] = swarm['pbest'][best]
+    return improved, best
+
+def lvl2_bounds(search_space):
+    """Lower and upper bounds of a Level-2 position [c_nf, c_fs, c_pp, c_ss, p_fs, p_ss, p_pp, op]."""
+    keys = ('c_nf', 'c_fs', 'c_pp', 'c_ss', 'p_fs', 'p_ss', 'p_pp', 'op')
+    return (np.array([search_space[k][0] for k in keys], np.float32),
+            np.array([search_space[k][1] for k in keys], np.float32))
+
+def odd_integers(rng, bounds, N):
+    """N draws from range(lo, hi, 2), like random.randrange(lo, hi, 2)."""
+    return bounds[0] + 2 * rng.integers(0, len(range(bounds[0], bounds[1], 2)), N)
+
+def sample_lvl1(swarm, search_space, rng):
+    """Fill a Level-1 swarm with random positions [nC, nP, nF] (nP ≤ nC, nF ≤ nC) and their bounds."""
+    N = len(swarm['pos'])
+    nC = rng.integers(search_space['nC'][0], search_space['nC'][1], N, endpoint=True)
+    nP = rng.integers(search_space['nP'][0], nC, endpoint=True)
+    nF = rng.integers(search_space['nF'][0], nC, endpoint=True)
+    swarm['lo'][:] = [search_space['nC'][0], search_space['nP'][0], search_space['nF'][0]]
+    swarm['hi'][:] = np.stack([np.full(N, search_space['nC'][1]), nC, nC], axis=1)
+    swarm['pos'][:] = np.stack([nC, nP, nF], axis=1)
+    swarm['pbest'][:] = swarm['pos']
+
+def sample_lvl2(search_space, N, rng):
+    """Draw N random Level-2 positions (odd filter sizes, c_ss ≤ c_fs, p_pp ≤ p_fs), one per row."""
+    randint = lambda key, high=None: rng.integers(search_space[key][0], search_space[key][1] if high is None else high,
+                                                  N, endpoint=True)
+    c_fs = odd_integers(rng, search_space['c_fs'], N)
+    p_fs = odd_integers(rng, search_space['p_fs'], N)
+    return np.stack([randint('c_nf'),
+                     c_fs,
+                     randint('c_pp'),
+                     randint('c_ss', np.minimum(search_space['c_ss'][1], c_fs)),
+                     p_fs,
+                     randint('p_ss'),
+                     randint('p_pp', np.minimum(search_space['p_pp'][1], p_fs)),
+                     randint('op')], axis=1).astype(np.float32)
+
+def encode_lvl2(pos, lo, hi):
+    """Map integer Level-2 positions into the unit box searched by pyswarms (each integer owns an equal slice)."""
+    return (pos - lo + 0.5) / (hi - lo + 1)
+
+def decode_lvl2(X, lo, hi):
+    """Inverse of encode_lvl2, also enforcing c_ss ≤ c_fs."""
+    pos = np.minimum(np.floor(lo + X * (hi - lo + 1)), hi)
+    pos[:, 3] = np.minimum(pos[:, 3], pos[:, 1])
+    return pos.astype(int)
+
+def set_max_vel(swarm, max_vel):
+    """Limit each particle's speed per dimension to a fraction max_vel of its position range."""
+    swarm['vmax'][:] = max_vel * (swarm['hi'] - swarm['lo'])
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _update(vel, pos, pbest, gbest, lo, hi, vmax, w, c1, c2, r1, r2):
+    for i in prange(pos.shape[0]):
+        for j in range(pos.shape[1]):
+            vel[i, j] = w*vel[i, j] + c1*r1[i]*(pbest[i, j] - pos[i, j]) + c2*r2[i]*(gbest[j] - pos[i, j])
+            vel[i, j] = min(max(vel[i, j], -vmax[i, j]), vmax[i, j])
+            pos[i, j] = np.trunc(min(max(pos[i, j] + vel[i, j], lo[i, j]), hi[i, j]))
+
+def update_swarm(swarm, w, c1, c2, rng):
+    """Move all particles of a swarm at once (velocity update, then bounded integer position update)."""
+    r1, r2 = rng.random((2, len(swarm['pos'])), dtype=np.float32)
+    _update(swarm['vel'], swarm['pos'], swarm['pbest'], swarm['gbest'], swarm['lo'], swarm['hi'], swarm['vmax'],
+            np.float32(w), np.float32(c1), np.float32(c2), r1, r2)
 
 class Particle_L1:
-    def __init__(self, search_space):
-        self.nC = random.randint(search_space['nC'][0], search_space['nC'][1])
-        self.nP = random.randint(search_space['nP'][0], self.nC)
-        self.nF = random.randint(search_space['nF'][0], self.nC)
-        self.bounds = [[search_space['nC'][0], search_space['nC'][1]], 
-                       [search_space['nP'][0], self.nC], 
-                       [search_space['nF'][0], self.nC]]
-
-        self.pos_i = [self.nC, self.nP, self.nF]        # Particle position 
-        self.vel_i = [0, 0, 0]                          # Particle velocity
-        
-        self.F_i = -float("inf")                        # Current fitness
-        self.pbest_i = self.pos_i.copy()                # Personal best position
-        self.pbest_i_F = self.F_i                       # Personal best fitness
+    def __init__(self, search_space, swarm, i, rng):
+        self.swarm = swarm                              # Swarm Level-1 arrays this particle is a view of (see sample_lvl1)
+        self.i = i                                      # Row of this particle in the swarm arrays
 
         self.swarm_size_lvl2 = 5*self.nC                # Swarm size at Swarm Level-2
-        self.swarm_lvl2 = [Particle_L2(search_space) for _ in range(self.swarm_size_lvl2)]
-        self.bestParticle_ij = None                     # Best particle from swarm level-2
-
-    def update_velocity(self, gbest_i, w, c1, c2):
-        r1 = random.uniform(0,1)
-        r2 = random.uniform(0,1)
-        for i in range(len(self.vel_i)):
-            self.vel_i[i] = w*self.vel_i[i] + c1*r1*(self.pbest_i[i] - self.pos_i[i]) + c2*r2*(gbest_i[i] - self.pos_i[i])
-        print("\n==========================================================")
-        print("Velocity1: ", ['{:.2f}'.format(v) for v in self.vel_i], f" (w, r1, r2 : {w}, ", '{:.2f}, '.format(r1), '{:.2f})'.format(r2))
-        print(f"pos_i {self.pos_i}, pbest_i: {self.pbest_i}, gbest_i: {gbest_i}")
-        print("==========================================================\n")
-
-    def update_position(self):
-        for i in range(len(self.pos_i)):
-            self.pos_i[i] += self.vel_i[i]
-            self.pos_i[i] = max(self.bounds[i][0], min(self.pos_i[i], self.bounds[i][1]))
-            self.pos_i[i] = int (self.pos_i[i])
-        
-    def __repr__(self):
-        return f"nC: {self.nC}, nP: {self.nP}, nF: {self.nF}"
+        pos = encode_lvl2(sample_lvl2(search_space, self.swarm_size_lvl2, rng), *lvl2_bounds(search_space))
+        self.swarm_lvl2_state = {
+                                 'pos':        pos,
+                                 'vel':        np.zeros((self.swarm_size_lvl2, 8)),
+                                 'pbest_pos':  pos.copy(),
+                                 'pbest_cost': np.full(self.swarm_size_lvl2, np.inf),
+                                }                       # Swarm Level-2 in pyswarms' unit box
+        self.gbest_ij = None                            # Best position from swarm level-2
+        self.pbest_ij = None                            # Best position from swarm level-2 at pbest_i
 
-    def __str__(self):
-        return f"{self.pos_i}"
+    @property
+    def pos_i(self):
+        return [int(v) for v in self.swarm['pos'][self.i]]
 
-class Particle_L2:
-    def __init__(self, search_space):
-        self.c_nf = random.randint(search_space['c_nf'][0], search_space['c_nf'][1])
-        self.c_fs = random.randrange(search_space['c_fs'][0], search_space['c_fs'][1], 2)
-        self.c_pp = random.randint(search_space['c_pp'][0], search_space['c_pp'][1])
-        self.c_ss = random.randint(search_space['c_ss'][0], self.c_fs)
-        self.p_fs = random.randrange(search_space['p_fs'][0], search_space['p_fs'][1], 2)
-        self.p_ss = random.randint(search_space['p_ss'][0], search_space['p_ss'][1])
-        self.p_pp = random.randint(search_space['p_pp'][0], self.p_fs)
-        self.op   = random.randint(search_space['op'][0], search_space['op'][1])
-        self.bounds = [[search_space['c_nf'][0], search_space['c_nf'][1]],
-                       [search_space['c_fs'][0], search_space['c_fs'][1]],
-                       [search_space['c_pp'][0], search_space['c_pp'][1]],
-                       [search_space['c_ss'][0], self.c_fs],
-                       [search_space['p_fs'][0], search_space['p_fs'][1]],
-                       [search_space['p_ss'][0], search_space['p_ss'][1]],
-                       [search_space['p_pp'][0], self.p_fs],
-                       [search_space['op'][0], search_space['op'][1]]]
-
-        self.pos_ij = [self.c_nf, self.c_fs, self.c_pp,
-                       self.c_ss, self.p_fs, self.p_ss, 
-                       self.p_pp, self.op]              # Particle position
-        self.vel_ij = [0] * len(self.pos_ij)            # Particle velocity 
-        
-        self.F_ij = -float("inf")                       # Current fitness
-        self.pbest_ij = self.pos_ij.copy()              # Personal best position
-        self.pbest_ij_F = self.F_ij                     # Personal best fitness
-
-    def evaluate(self, cnn, x, y):
-        return cnn.model.evaluate(x, y)[1]
-
-    def update_velocity(self, gbest_ij, w, c1, c2):
-        r1 = random.uniform(0,1)
-        r2 = random.uniform(0,1)
-        for i in range(len(self.vel_ij)):
-            self.vel_ij[i] = w*self.vel_ij[i] + c1*r1*(self.pbest_ij[i] - self.pos_ij[i]) + c2*r2*(gbest_ij[i] - self.pos_ij[i])
-        print("\n==========================================================")
-        print("Velocity2: ", ['{:.2f}'.format(v) for v in self.vel_ij], f" (w, r1, r2 : {w}, ", '{:.2f}, '.format(r1), '{:.2f})'.format(r2))
-        print(f"pos_ij {self.pos_ij}, pbest_ij: {self.pbest_ij}, gbest_ij: {gbest_ij}")
-        print("==========================================================\n")
-                             
-    def update_position(self):
-        for i in range(len(self.pos_ij)):
-            self.pos_ij[i] += self.vel_ij[i]
-            self.pos_ij[i] = int (self.pos_ij[i])
-            self.pos_ij[i] = max(self.bounds[i][0], min(self.pos_ij[i], self.bounds[i][1]))
+    @property
+    def vel_i(self):
+        return self.swarm['vel'][self.i].tolist()
+
+    @property
+    def pbest_i(self):
+        return [int(v) for v in self.swarm['pbest'][self.i]]
+
+    @property
+    def F_i(self):
+        return self.swarm['F'][self.i]
+
+    @F_i.setter
+    def F_i(self, value):
+        self.swarm['F'][self.i] = value
+
+    @property
+    def pbest_i_F(self):
+        return self.swarm['pbest_F'][self.i]
+
+    nC = property(lambda self: self.pos_i[0])
+    nP = property(lambda self: self.pos_i[1])
+    nF = property(lambda self: self.pos_i[2])
 
     def __repr__(self):
-        return f"c_nf: {self.c_nf}, c_fs: {self.c_fs}, c_pp: {self.c_pp}, c_ss: {self.c_ss}, p_fs: {self.p_fs}, p_ss: {self.p_ss}, p_pp: {self.p_pp}, op: {self.op}"
+        return f"nC: {self.nC}, nP: {self.nP}, nF: {self.nF}"
 
     def __str__(self):
-        return f"{self.pos_ij}"
+        return f"{self.pos_i}"
 
 class Hybrid_MPSO_CNN:
-    def __init__(self, x_train, y_train, x_test, y_test, input_shape, output_shape):
-        self.c1 = 2                                     # Social coefficient
-        self.c2 = 2                                     # Cognitive coefficient
-        self.max_iter_lvl1 = random.randint(5,8)        # Maximum iterations at Swarm Level-1
+    def __init__(self, x_train, y_train, x_test, y_test, input_shape, output_shape, client=None, seed=None,
+                 n_procs=0, n_gpus=0, multi_head=False, log_file=None):
+        if client is not None and n_procs:
+            raise ValueError("Use either a Dask client or Level-1 worker processes, not both")
+        self.rng = np.random.default_rng(seed)          # Random generator of the swarm initialization and updates
+        self.c1 = 2.05                                  # Social coefficient
+        self.c2 = 2.05                                  # Cognitive coefficient
+        self.max_vel = 0.5                              # Maximum velocity (fraction of each dimension's range)
+        self.max_iter_lvl1 = int(self.rng.integers(5, 8, endpoint=True))  # Maximum iterations at Swarm Level-1
         self.max_iter_lvl2 = 5                          # Maximum iterations at Swarm Level-2
+        self.max_epochs_lvl2 = 10                       # Training epochs of the CNNs surviving successive halving
         self.search_space = {
                              'nC':   (1, 5),            # Number of convolutional layers
                              'nP':   (1, 5),            # Number of pooling layers
@@ -125,79 +429,210 @@ class Hybrid_MPSO_CNN:
                              'op':   (1, 1024)          # Number of neurons
                             }                           # Range of hyperparameters (Based on Table 1)
         self.swarm_size_lvl1 = 5                        # Swarm size at Swarm Level-1 (nP ≤ nC, nF ≤ nC)
-        self.swarm_lvl1 = [Particle_L1(self.search_space) for _ in range(self.swarm_size_lvl1)]
+        self.swarm_lvl1_state = init_swarm(self.swarm_size_lvl1, 3)
+        sample_lvl1(self.swarm_lvl1_state, self.search_space, self.rng)
+        self.swarm_lvl1 = [Particle_L1(self.search_space, self.swarm_lvl1_state, i, self.rng) for i in range(self.swarm_size_lvl1)]
+        set_max_vel(self.swarm_lvl1_state, self.max_vel)
+        self.lo_lvl2, self.hi_lvl2 = lvl2_bounds(self.search_space)
         self.x_train = x_train                          # Training data input
         self.y_train = y_train                          # Training data output
         self.x_test  = x_test                           # Testing data input
         self.y_test  = y_test                           # Testing data output
         self.input_shape = input_shape                  # Input data shape
         self.output_shape = output_shape                # Output data shape
+        self.client = client                            # Dask client evaluating CNNs concurrently (None: serial)
+        self.n_procs = n_procs                          # Processes optimizing Level-1 particles concurrently (0: serial)
+        self.n_gpus = n_gpus                            # GPUs shared round-robin by those processes
+        self.multi_head = multi_head                    # Train each rung as one multi-head model (without Dask)
+        self.log_file = log_file                        # Log file shared by all processes (None: logging config)
+        self.executor = None
+        if log_file is not None:
+            log_to_file(log_file)
+            if client is not None:
+                client.run(log_to_file, log_file)
+        self.fitness_cache = {}                         # Fitness of already trained (l1_pos, l2_pos) pairs
+        self.checkpoint_dir = None                      # CNN weights between successive-halving rungs (one per run)
+        self.train_handles = None                       # Shared memory handles of (x_train, y_train) during run()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.train_handles is not None:              # Workers attach to the shared copy instead
+            state.update(x_train=None, y_train=None)
+        state.update(client=None, executor=None, n_procs=0)
+        return state
 
-    def calculate_omega(self, t, t_max, alpha=0.2):
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.train_handles is not None:
+            self.x_train, self.y_train = map(attach_array, self.train_handles)
+
+    @staticmethod
+    def calculate_omega(t, t_max, alpha=0.2):
         if t < alpha * t_max:
             return 0.9
-        return 1 / (1 + math.e ** ((10 * t - t_max) / t_max))
+        return 1.0 / (1.0 + math.exp((10.0 * t - t_max) / t_max))
 
     def level1_optimize(self):
-        bestParticle_i = None
-        gbest_i_F = -float("inf")
+        swarm = self.swarm_lvl1_state
+        omegas = np.array([self.calculate_omega(t, self.max_iter_lvl1) for t in range(self.max_iter_lvl1)])
         for t in range(self.max_iter_lvl1):
-            w = self.calculate_omega(t, self.max_iter_lvl1)
-            for i, particle_l1 in enumerate(self.swarm_lvl1):
-                print(f"\n*---L1itr_{t+1}/{self.max_iter_lvl1} PL1num_{i+1}/{len(self.swarm_lvl1)}---*")
-                particle_l1.bestParticle_ij, particle_l1.F_i = self.level2_optimize(particle_l1, w)
-                if particle_l1.F_i > particle_l1.pbest_i_F:
-                    print(f"\n!!!!!!!! pbest_i updated from {particle_l1.pbest_i} to {particle_l1.pos_i} !!!!!!!!")
-                    particle_l1.pbest_i_F = particle_l1.F_i
-                    particle_l1.pbest_i = particle_l1.pos_i.copy()
-                if particle_l1.F_i > gbest_i_F:
-                    print(f"!!!!!!!! gbest_i updated from {bestParticle_i} to {particle_l1.pos_i} !!!!!!!!\n")
-                    gbest_i_F = particle_l1.F_i
-                    bestParticle_i = particle_l1
-                particle_l1.update_velocity(bestParticle_i.pos_i, w, self.c1, self.c2)
-                particle_l1.update_position()
-
-        print("\n$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$")
-        print(f"pl1gbest: {bestParticle_i}, pl2gbest: {particle_l1.bestParticle_ij}, pl1fitness: {particle_l1.F_i}")
-        print("$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$\n")
-        return bestParticle_i, particle_l1.bestParticle_ij, particle_l1.F_i
+            w = omegas[t]
+            logger.info("*---L1itr_%d/%d PL1size_%d---*", t+1, self.max_iter_lvl1, len(self.swarm_lvl1))
+            self.evaluate_lvl1(w)
+            gbest_i, gbest_i_F = swarm['gbest'].astype(int).tolist(), swarm['pbest_F'].max()
+            improved, best = update_pbest(swarm)
+            for i in np.flatnonzero(improved):
+                self.swarm_lvl1[i].pbest_ij = list(self.swarm_lvl1[i].gbest_ij)
+            if swarm['pbest_F'][best] > gbest_i_F:
+                logger.info("!!!!!!!! gbest_i updated from %s to %s !!!!!!!!", gbest_i, self.swarm_lvl1[best].pbest_i)
+            update_swarm(swarm, w, self.c1, self.c2, self.rng)
+
+        best = self.swarm_lvl1[np.argmax(swarm['pbest_F'])]
+        logger.info("$$$$ pl1gbest: %s, pl2gbest: %s, pl1fitness: %s $$$$", best.pbest_i, best.pbest_ij, best.pbest_i_F)
+        return best.pbest_i, best.pbest_ij, best.pbest_i_F
         
+    def evaluate_lvl1(self, w):
+        seeds = self.rng.integers(2**32, size=len(self.swarm_lvl1))
+        if self.executor is None:
+            for i, particle_l1 in enumerate(self.swarm_lvl1):
+                logger.info("*---PL1num_%d/%d---*", i+1, len(self.swarm_lvl1))
+                np.random.seed(seeds[i])                # pyswarms draws from the legacy global generator
+                particle_l1.gbest_ij, particle_l1.F_i = self.level2_optimize(particle_l1, w)
+            return
+
+        results = self.executor.map(_run_level2, [self] * len(self.swarm_lvl1), self.swarm_lvl1,
+                                    [w] * len(self.swarm_lvl1), seeds)
+        for particle_l1, (gbest_ij, F_i, swarm_lvl2_state, new_fitnesses) in zip(self.swarm_lvl1, results):
+            particle_l1.gbest_ij, particle_l1.F_i = gbest_ij, F_i
+            for key, array in swarm_lvl2_state.items():
+                particle_l1.swarm_lvl2_state[key][...] = array
+            self.fitness_cache.update(new_fitnesses)
+
     def level2_optimize(self, particle_l1, w):
-        bestParticle_ij = None
-        gbest_ij_F = -float("inf")
+        # Personal bests persist across Level-1 iterations, like the original Particle_L2s did; the
+        # returned gbest_ij is the best position evaluated in this call, i.e. at the current pos_i.
+        state = particle_l1.swarm_lvl2_state
+        swarm = Swarm(position=state['pos'].copy(), velocity=state['vel'].copy(),
+                      options={'c1': self.c1, 'c2': self.c2, 'w': w},
+                      pbest_pos=state['pbest_pos'].copy(), pbest_cost=state['pbest_cost'].copy())
+        with quiet_pyswarms():
+            topology = Star()
+            bh, vh = BoundaryHandler(strategy='nearest'), VelocityHandler(strategy='unmodified')
+        bounds, clamp = (np.zeros(8), np.ones(8)), (-self.max_vel, self.max_vel)
+
+        gbest_ij, gbest_ij_F = None, -float("inf")
         for t in range(self.max_iter_lvl2):
-            for i, particle_l2 in enumerate(particle_l1.swarm_lvl2):
-                print(f"* --L2itr_{t+1}/{self.max_iter_lvl2} PL2num_{i+1}/{len(particle_l1.swarm_lvl2)}-- *\n")
-                print(particle_l1, particle_l2, " --> ", "[nC, nP, nF] [c_nf, c_fs, c_pp, c_ss, p_fs, p_ss, p_pp, op]")
+            logger.info("* --L2itr_%d/%d PL2size_%d-- *", t+1, self.max_iter_lvl2, len(swarm.position))
+            positions = decode_lvl2(swarm.position, self.lo_lvl2, self.hi_lvl2)
+            F = self.evaluate_lvl2(particle_l1, positions, gbest_ij_F)
+            if gbest_ij is None or F.max() > gbest_ij_F:
+                gbest_ij, gbest_ij_F = positions[np.argmax(F)].tolist(), F.max()
+            swarm.current_cost = np.where(F > -np.inf, -F, LVL2_PENALTY)
+            swarm.pbest_pos, swarm.pbest_cost = compute_pbest(swarm)
+            swarm.best_pos, swarm.best_cost = topology.compute_gbest(swarm)
+            swarm.velocity = topology.compute_velocity(swarm, clamp, vh, bounds)
+            swarm.position = topology.compute_position(swarm, bounds, bh)
+
+        state['pos'][...] = swarm.position
+        state['vel'][...] = swarm.velocity
+        state['pbest_pos'][...] = swarm.pbest_pos
+        state['pbest_cost'][...] = swarm.pbest_cost
+        logger.info("$$$$ pl2gbest: %s, pl2fitness: %s $$$$", gbest_ij, gbest_ij_F)
+        return gbest_ij, gbest_ij_F
+    
+    def evaluate_lvl2(self, particle_l1, positions, gbest_F):
+        F = np.full(len(positions), -np.inf)
+        pending = {}                                    # Particles sharing a position are trained once
+        for j, l2_pos in enumerate(positions):
+            key = (tuple(particle_l1.pos_i), tuple(l2_pos.tolist()))
+            if key not in self.fitness_cache and not CNN._is_feasible(*key, self.input_shape):
+                self.fitness_cache[key] = -float("inf")  # Penalized without building the model
+            if key in self.fitness_cache:
+                F[j] = self.fitness_cache[key]
+            else:
+                pending.setdefault(key, []).append(j)
+
+        # Successive halving: all pending CNNs train 1 epoch, then the better half of each rung (at
+        # least one CNN) keeps training (2, 4, ... more epochs) until max_epochs_lvl2 is reached.
+        # Only full-budget fitnesses (and failures) are cached, so a CNN eliminated early isn't
+        # ranked against fully trained ones on later visits.
+        rung, trained, extra = list(pending.items()), 0, 1
+        while rung:
+            epochs = min(extra, self.max_epochs_lvl2 - trained)
+            logger.info("* --Rung of %d CNNs, epochs %d-%d/%d-- *", len(rung), trained+1, trained+epochs, self.max_epochs_lvl2)
+            scores = {}
+            for (key, rows), F_ij in zip(rung, self.train_rung(particle_l1, rung, gbest_F, epochs, trained)):
+                F[rows] = scores[key] = F_ij
+                if trained + epochs >= self.max_epochs_lvl2 or F_ij == -float("inf"):
+                    self.fitness_cache[key] = F_ij
+            trained, extra = trained + epochs, 2 * extra
+            if trained >= self.max_epochs_lvl2:
+                break
+            rung = sorted((item for item in rung if scores[item[0]] > -float("inf")),
+                          key=lambda item: scores[item[0]], reverse=True)[:max(1, len(rung) // 2)]
+        return F
+
+    def train_rung(self, particle_l1, rung, gbest_F, epochs, initial_epoch):
+        checkpoints = [os.path.join(self.checkpoint_dir, f"pl1_{particle_l1.i}_pl2_{rows[0]}.weights.h5") for _, rows in rung]
+        fitnesses = [-float("inf")] * len(rung)
+        if self.client is None and self.multi_head and len(rung) > 1:
+            for key, _ in rung:
+                logger.debug("%s %s --> [nC, nP, nF] [c_nf, c_fs, c_pp, c_ss, p_fs, p_ss, p_pp, op]", particle_l1, list(key[1]))
+            try:
+                return eval_particles([key for key, _ in rung], self.x_train, self.y_train, self.input_shape,
+                                      self.output_shape, epochs, initial_epoch, checkpoints)
+            except Exception as e:                      # Not the CNNs' fault: train them one at a time below
+                logger.info("^^^^^^ Joint training failed, training the rung CNN by CNN ^^^^^^ %s", e)
+
+        if self.client is None:
+            for n, ((key, _), checkpoint) in enumerate(zip(rung, checkpoints)):
+                logger.debug("%s %s --> [nC, nP, nF] [c_nf, c_fs, c_pp, c_ss, p_fs, p_ss, p_pp, op]", particle_l1, list(key[1]))
                 try:
-                    cnn = CNN(particle_l1.pos_i, particle_l2.pos_ij)
-                    model = cnn.buid_model(self.input_shape, self.output_shape)
-                    model.compile(optimizer='adam', loss='mse', metrics=['accuracy'])
-                    model.fit(self.x_train, self.y_train,  epochs=10, batch_size=128, validation_split=0.2)
-                    particle_l2.F_ij = particle_l2.evaluate(cnn, self.x_train, self.y_train)
+                    fitnesses[n] = eval_particle(*key, self.x_train, self.y_train, self.input_shape, self.output_shape,
+                                                 gbest_F, epochs, initial_epoch, checkpoint)
                 except Exception as e:
-                    print("^^^^^^ Invalid hyperparameters ^^^^^^")
-                    print(e)
-                    continue
-                if particle_l2.F_ij > particle_l2.pbest_ij_F:
-                    print(f"\n!!!!!!!! pbest_ij updated from {particle_l2.pbest_ij} to {particle_l2.pos_ij} !!!!!!!!")
-                    particle_l2.pbest_ij_F = particle_l2.F_ij
-                    particle_l2.pbest_ij = particle_l2.pos_ij.copy()
-                if particle_l2.F_ij > gbest_ij_F:
-                    print(f"!!!!!!!! gbest_ij updated from {bestParticle_ij} to {particle_l2.pos_ij} !!!!!!!!\n")
-                    gbest_ij_F = particle_l2.F_ij
-                    bestParticle_ij = particle_l2
-                particle_l2.update_velocity(bestParticle_ij.pos_ij, w, self.c1, self.c2)
-                particle_l2.update_position()
-        
-        print("\n$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$")
-        print(f"pl2gbest: {bestParticle_ij}, pl2fitness: {gbest_ij_F}")
-        print("$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$\n")
-        return bestParticle_ij, gbest_ij_F
-    
+                    logger.info("^^^^^^ Invalid hyperparameters %s ^^^^^^ %s", key, e)
+            return fitnesses
+
+        from dask.distributed import as_completed
+        x, y = self.train_handles
+        futures = [self.client.submit(eval_particle, *key, x, y, self.input_shape, self.output_shape,
+                                      gbest_F, epochs, initial_epoch, checkpoint, pure=False)
+                   for (key, _), checkpoint in zip(rung, checkpoints)]
+        index = {future.key: n for n, future in enumerate(futures)}
+        for future in as_completed(futures):
+            n = index[future.key]
+            logger.debug("%s %s --> [nC, nP, nF] [c_nf, c_fs, c_pp, c_ss, p_fs, p_ss, p_pp, op]", particle_l1, list(rung[n][0][1]))
+            try:
+                fitnesses[n] = future.result()
+            except Exception as e:
+                logger.info("^^^^^^ Invalid hyperparameters %s ^^^^^^ %s", rung[n][0], e)
+        return fitnesses
+
     def run(self):
-        lvl1_bestP, lvl2_bestP, fitness = self.level1_optimize()
-        return lvl1_bestP.pos_i, lvl2_bestP.pos_ij, fitness
+        if self.n_procs:
+            # Spawned (not forked) workers, each pinned to one GPU before TensorFlow touches it.
+            context = multiprocessing.get_context('spawn')
+            ranks = context.Queue()
+            for rank in range(self.n_procs):
+                ranks.put(rank)
+            self.executor = ProcessPoolExecutor(self.n_procs, mp_context=context,
+                                                initializer=_init_process, initargs=(ranks, self.n_gpus, self.log_file))
+        self.checkpoint_dir = tempfile.mkdtemp(prefix='mpso_cnn_')
+        if self.client is not None or self.n_procs:
+            self.train_handles = (share_array(self.x_train), share_array(self.y_train))
+        try:
+            return self.level1_optimize()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+            shutil.rmtree(self.checkpoint_dir, ignore_errors=True)
+            self.checkpoint_dir = None
+            if self.train_handles is not None:
+                for handle in self.train_handles:
+                    unlink_array(handle)
+                self.train_handles = None
     
     def __repr__(self):
         return f"Max_iter_lvl1: {self.max_iter_lvl1}, Max_iter_lvl2: {self.max_iter_lvl2}"
@@ -216,33 +651,102 @@ class CNN:
         self.p_pp = l2_hyperparameters[6]               # padding pixels in pooling layer
         self.op   = l2_hyperparameters[7]               # number of output neurons in the fully connected layer
 
-        self.model = Sequential()
+        self.model = None
+
+    def architecture(self, input_shape, output_shape):
+        return (f"{self.nC}-{self.nP}-{self.nF}-{self.c_nf}-{self.c_fs}-{self.c_pp}-{self.c_ss}-"
+                f"{self.p_fs}-{self.p_ss}-{self.p_pp}-{self.op}-{tuple(input_shape)}-{output_shape}")
+
+    @staticmethod
+    def _is_feasible(l1_hyperparameters, l2_hyperparameters, input_shape):
+        """Whether the conv/pool stack of build_head keeps every output dim positive for this input shape."""
+        def out(size, k, s, same):
+            return math.ceil(size / s) if same else (size - k) // s + 1
+
+        nC, nP = l1_hyperparameters[:2]
+        c_nf, c_fs, c_pp, c_ss, p_fs, p_ss, p_pp = l2_hyperparameters[:7]
+        dims = list(input_shape[:-1] if K.image_data_format() == 'channels_last' else input_shape[1:])
+        for i in range(nC):
+            dims = [out(d, c_fs, c_ss, c_pp) for d in dims]
+            if min(dims) <= 0:
+                return False
+            if i < nP and min(dims + [c_nf]) >= p_fs:
+                dims = [out(d, p_fs, p_ss, p_pp) for d in dims]
+                if min(dims) <= 0:
+                    return False
+        return True
 
     def buid_model(self, input_shape, output_shape):
+        setup_gpus()                                    # Sets the float16 policy before any layer is created
+        key = self.architecture(input_shape, output_shape)
+        if key in _model_cache:
+            self.model, init_weights = _model_cache[key]
+            _model_cache.move_to_end(key)
+            self.model.set_weights(init_weights)
+            reset_optimizer(self.model.optimizer)       # Recompiling would discard the traced train function
+            return self.model
+
+        inputs = Input(shape = input_shape)
+        self.model = Model(inputs, self.build_head(inputs, output_shape))
+        compile_model(self.model)
+
+        _model_cache[key] = (self.model, self.model.get_weights())
+        if len(_model_cache) > MODEL_CACHE_SIZE:
+            _model_cache.popitem(last=False)
+        return self.model
+
+    def build_head(self, inputs, output_shape, name=None):
+        x = inputs
         for i in range(self.nC):
-            self.model.add(Conv2D(filters = self.c_nf, 
-                                  kernel_size = (self.c_fs, self.c_fs), 
-                                  strides = (self.c_ss, self.c_ss), 
-                                  padding = 'valid' if self.c_pp == 0 else 'same', 
-                                  activation = 'relu',
-                                  input_shape = input_shape))
-
-            input_shape = self.model.layers[-1].output_shape[1:]
-            
-            if i < self.nP and all(dim >= self.p_fs for dim in input_shape):
-                self.model.add(MaxPooling2D(pool_size = (self.p_fs, self.p_fs), 
-                                            strides = (self.p_ss, self.p_ss), 
-                                            padding = 'valid' if self.p_pp == 0 else 'same'))
-                                                   
-        self.model.add(Flatten())
-        
+            x = Conv2D(filters = self.c_nf, 
+                       kernel_size = (self.c_fs, self.c_fs), 
+                       strides = (self.c_ss, self.c_ss), 
+                       padding = 'valid' if self.c_pp == 0 else 'same', 
+                       activation = 'relu')(x)
+
+            if i < self.nP and all(dim >= self.p_fs for dim in x.shape[1:]):
+                x = MaxPooling2D(pool_size = (self.p_fs, self.p_fs), 
+                                 strides = (self.p_ss, self.p_ss), 
+                                 padding = 'valid' if self.p_pp == 0 else 'same')(x)
+
+        x = Flatten()(x)
+
         for i in range(self.nF):
-            self.model.add(Dense(units = self.op, activation = 'relu'))
-            self.model.add(Dropout(0.2))
+            x = Dense(units = self.op, activation = 'relu')(x)
+            x = Dropout(0.2)(x)
 
-        self.model.add(Dense(units = output_shape, activation = 'softmax'))
-    
-        return self.model
+        return Dense(units = output_shape, activation = 'softmax', dtype = 'float32', name = name)(x)
+
+    def train_model(self, train_ds, val_ds, epochs=10, gbest_F=-float("inf"), initial_epoch=0, val_acc=()):
+        callbacks = [PredictiveEarlyStop(gbest_F, val_acc)] if gbest_F > -float("inf") else []
+        return self.model.fit(train_ds, validation_data=val_ds, epochs=initial_epoch + epochs,
+                              initial_epoch=initial_epoch, callbacks=callbacks)
+
+    def fitness(self, x, y=None, quantized=False):
+        if quantized:
+            return self.quantized_fitness(x if y is None else tf.data.Dataset.from_tensor_slices((x, y)).batch(128))
+        return self.model.evaluate(x, y)
+
+    def quantized_fitness(self, ds):
+        """[mse, accuracy] over a batched dataset, computed by an int8 post-training-quantized TFLite copy of the model."""
+        converter = tf.lite.TFLiteConverter.from_keras_model(self.model)
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        interpreter = tf.lite.Interpreter(model_content=converter.convert())
+        input_index = interpreter.get_input_details()[0]['index']
+        output_index = interpreter.get_output_details()[0]['index']
+        shape, squared_error, correct, n = None, 0.0, 0, 0
+        for x, y in ds.as_numpy_iterator():
+            if x.shape != shape:
+                shape = x.shape
+                interpreter.resize_tensor_input(input_index, shape)
+                interpreter.allocate_tensors()
+            interpreter.set_tensor(input_index, x.astype(np.float32))
+            interpreter.invoke()
+            pred = interpreter.get_tensor(output_index)
+            squared_error += np.square(pred - y).mean(axis=1).sum()
+            correct += (pred.argmax(axis=1) == y.argmax(axis=1)).sum()
+            n += len(x)
+        return [squared_error / n, correct / n]
 
     def __str__(self):
         model_summary = (
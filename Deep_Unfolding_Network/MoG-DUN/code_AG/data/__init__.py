@@ -3,15 +3,15 @@ from importlib import import_module
 from dataloader import MSDataLoader
 from torch.utils.data.dataloader import default_collate
 
+# (module, class) of each benchmark test set, without and with added noise
+BENCHMARKS = {
+    name: (('data.benchmark', 'Benchmark'), ('data.benchmark_noise', 'BenchmarkNoise'))
+    for name in ['Set5', 'Set14', 'BSD100', 'Urban100', 'Manga109']
+}
+
 class Data:
     def __init__(self, args):
-        kwargs = {}
-        if not args.cpu:
-            kwargs['collate_fn'] = default_collate
-            kwargs['pin_memory'] = True
-        else:
-            kwargs['collate_fn'] = default_collate
-            kwargs['pin_memory'] = False
+        kwargs = {'collate_fn': default_collate, 'pin_memory': not args.cpu}
 
         self.loader_train = None
         # if not True:
@@ -26,20 +26,11 @@ class Data:
                 **kwargs
             )
 
-        if args.data_test in ['Set5', 'Set14', 'BSD100', 'Urban100','Manga109']:
-            if not args.benchmark_noise:
-                module_test = import_module('data.benchmark')
-                testset = getattr(module_test, 'Benchmark')(args, train=False)
-            else:
-                module_test = import_module('data.benchmark_noise')
-                testset = getattr(module_test, 'BenchmarkNoise')(
-                    args,
-                    train=False
-                )
-
+        if args.data_test in BENCHMARKS:
+            module_name, class_name = BENCHMARKS[args.data_test][bool(args.benchmark_noise)]
         else:
-            module_test = import_module('data.' + args.data_test.lower())
-            testset = getattr(module_test, args.data_test)(args, train=False)
+            module_name, class_name = 'data.' + args.data_test.lower(), args.data_test
+        testset = getattr(import_module(module_name), class_name)(args, train=False)
 
         self.loader_test = MSDataLoader(
             args,